@@ -1,30 +1,432 @@
+import os
+import sys
+import mmap
 import time
-import base64
+import atexit
+import logging
+import binascii
+import ipaddress
+import threading
 import traceback
+from collections import deque
 from collections.abc import Generator
-from tkinter import image_names
+from concurrent.futures import ThreadPoolExecutor
+from functools import singledispatch
+from typing import ClassVar, Optional
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dify_plugin.entities.tool import ToolInvokeMessage
 from dify_plugin import Tool
+from dify_plugin.file.file import File
 from volcenginesdkarkruntime import Ark
 from volcenginesdkarkruntime.types.images import SequentialImageGenerationOptions
 
+logger = logging.getLogger(__name__)
+
+
+# 只在内网/本机可解析的主机名后缀
+_INTERNAL_HOST_SUFFIXES = (".local", ".localhost", ".internal", ".lan", ".home.arpa")
+
+
+def _is_public_url(url):
+    """判断URL是否可能被方舟从公网访问: 排除非http(s)、回环/私有/链路本地地址以及单段主机名(如docker服务名)"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return False
+    host = (parts.hostname or "").rstrip(".").lower()
+    if not host:
+        return False
+    try:
+        return ipaddress.ip_address(host).is_global
+    except ValueError:
+        pass
+    return "." in host and not host.endswith(_INTERNAL_HOST_SUFFIXES)
+
+
+def _map_file(path):
+    """以只读方式内存映射文件, 避免read()把整个文件拷贝到内存; 调用方负责close"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            # 空文件无法映射
+            return b""
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+@singledispatch
+def _load_image(image_file, messages):
+    """
+    获取图片文件数据, 按输入对象的类型分派; 未注册的类型依次尝试blob/read/path
+
+    Returns:
+        图片数据 (本地文件为mmap对象, 用完需close), 所有方法都失败时返回None; 过程信息追加到messages
+    """
+    file_content = None
+
+    if hasattr(image_file, 'blob'):
+        try:
+            file_content = image_file.blob
+            messages.append(f"从blob属性获取文件数据: 大小={len(file_content)/1024:.2f}KB")
+        except Exception as e:
+            messages.append(f"获取blob属性失败: {str(e)}")
+
+    # 尝试从read方法获取
+    if file_content is None and hasattr(image_file, 'read'):
+        try:
+            file_content = image_file.read()
+            messages.append("从可读对象获取文件数据")
+            # 如果是文件对象，可能需要重置文件指针
+            if hasattr(image_file, 'seek'):
+                image_file.seek(0)
+        except Exception as e:
+            messages.append(f"从read方法获取文件数据失败: {str(e)}")
+
+    # 尝试本地文件缓存方式
+    if file_content is None and hasattr(image_file, 'path'):
+        try:
+            file_content = _map_file(image_file.path)
+            messages.append(f"从本地缓存路径获取文件数据: {image_file.path}, 大小={len(file_content)/1024:.2f}KB")
+        except (TypeError, ValueError, OSError) as e:
+            messages.append(f"从本地缓存路径获取文件数据失败: {str(e)}")
+
+    return file_content
+
+
+@_load_image.register(str)
+def _load_image_path(image_file, messages):
+    """作为文件路径处理"""
+    try:
+        file_content = _map_file(image_file)
+        messages.append(f"从文件路径获取文件数据: {image_file}, 大小={len(file_content)/1024:.2f}KB")
+        return file_content
+    except (TypeError, ValueError, OSError) as e:
+        messages.append(f"从文件路径获取文件数据失败: {str(e)}")
+        return None
+
+
+@_load_image.register(File)
+def _load_image_file(image_file, messages):
+    """Dify上传的文件, 只需读取blob"""
+    try:
+        file_content = image_file.blob
+        messages.append(f"从blob属性获取文件数据: 大小={len(file_content)/1024:.2f}KB")
+        return file_content
+    except Exception as e:
+        messages.append(f"获取blob属性失败: {str(e)}")
+        return None
+
 
 class Image2ImageTool(Tool):
+    # 设置环境变量DOUBAO_DEBUG时才把完整堆栈附加到返回消息中, 否则只记录到日志
+    _DEBUG = bool(os.environ.get("DOUBAO_DEBUG"))
+
+    # 分块编码的块大小, 必须是3的倍数, 这样各块的base64输出可以直接拼接
+    _ENCODE_CHUNK_SIZE = 57 * 1024
+    # 下载图片的重试次数及退避基数(秒)
+    _DOWNLOAD_RETRIES = 2
+    _DOWNLOAD_BACKOFF = 0.5
+    # 单张图片允许下载的最大字节数
+    _MAX_DOWNLOAD_BYTES = 50 * 1024 * 1024
+    # 并发处理输入图片的最大线程数
+    _MAX_PREPARE_WORKERS = 8
+    # 最终汇总消息中保留的最近图片信息条数
+    _IMAGES_INFO_RECAP = 15
+
+    # 下载图片共用的连接池会话, 跨图片和跨调用复用TCP/TLS连接
+    _SESSION: ClassVar[Optional[requests.Session]] = None
+    _SESSION_LOCK: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def _session(cls) -> requests.Session:
+        """获取(懒创建)共用的requests.Session"""
+        if cls._SESSION is None:
+            with cls._SESSION_LOCK:
+                if cls._SESSION is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=8,
+                        pool_maxsize=16,
+                        # 连接/读取错误由_download_image统一重试, 这里只重试网关类的状态码, 避免两层重试叠加
+                        max_retries=Retry(
+                            total=3, connect=0, read=0, other=0, status=3,
+                            backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                        ),
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    cls._SESSION = session
+        return cls._SESSION
+
+    # 按(base_url, api_key)缓存的Ark客户端, 复用其连接池和TLS会话
+    _CLIENTS: ClassVar[dict[tuple[str, str], Ark]] = {}
+    _CLIENTS_LOCK: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def _ark(cls, base_url: str, api_key: str) -> Ark:
+        """获取(懒创建)与凭据对应的Ark客户端"""
+        key = (base_url, api_key)
+        client = cls._CLIENTS.get(key)
+        if client is None:
+            with cls._CLIENTS_LOCK:
+                client = cls._CLIENTS.get(key)
+                if client is None:
+                    client = Ark(base_url=base_url, api_key=api_key)
+                    cls._CLIENTS[key] = client
+        return client
+
+    @classmethod
+    def _close_clients(cls) -> None:
+        """进程退出时关闭缓存的Ark客户端"""
+        with cls._CLIENTS_LOCK:
+            clients = list(cls._CLIENTS.values())
+            cls._CLIENTS.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                logger.debug("关闭Ark客户端失败", exc_info=True)
+
+    # 按2的幂分桶复用的下载缓冲池, 避免每次调用重新申请数MB内存
+    # 每桶最多2个、单个最大8MB, 空闲时最多保留约32MB
+    _BUF_POOL: ClassVar[dict[int, list[bytearray]]] = {}
+    _BUF_POOL_LOCK: ClassVar[threading.Lock] = threading.Lock()
+    _BUF_POOL_PER_BUCKET = 2
+    _BUF_POOL_MAX_BYTES = 8 * 1024 * 1024
+
+    @classmethod
+    def _acquire_buffer(cls, nbytes: int) -> bytearray:
+        """取出容量不小于nbytes的缓冲区, 实际大小向上取整到2的幂, 使用时需按实际长度切片"""
+        if nbytes <= 0:
+            return bytearray()
+        size = 1 << (nbytes - 1).bit_length()
+        with cls._BUF_POOL_LOCK:
+            bucket = cls._BUF_POOL.get(size)
+            if bucket:
+                return bucket.pop()
+        return bytearray(size)
+
+    @classmethod
+    def _release_buffer(cls, buf: bytearray) -> None:
+        """归还缓冲区; 大小不是2的幂(已被扩容)、过大或桶已满时直接丢弃"""
+        size = len(buf)
+        if size == 0 or size & (size - 1) or size > cls._BUF_POOL_MAX_BYTES:
+            return
+        with cls._BUF_POOL_LOCK:
+            bucket = cls._BUF_POOL.setdefault(size, [])
+            if len(bucket) < cls._BUF_POOL_PER_BUCKET:
+                bucket.append(buf)
+
     @staticmethod
-    def _encode_image(file_data):
-        """将图片文件编码为base64"""
+    def _sniff_mime(buf) -> str:
+        """根据文件头魔数判断图片MIME类型, 无法识别时按JPEG处理"""
+        if buf[:8] == b"\x89PNG\r\n\x1a\n":
+            return "image/png"
+        if buf[:3] == b"\xff\xd8\xff":
+            return "image/jpeg"
+        if buf[:4] == b"RIFF" and buf[8:12] == b"WEBP":
+            return "image/webp"
+        if buf[:6] in (b"GIF87a", b"GIF89a"):
+            return "image/gif"
+        return "image/jpeg"
+
+    @classmethod
+    def _encode_image(cls, file_data, prefix=b""):
+        """将图片文件编码为base64, 分块写入预分配的缓冲区, 避免中间拷贝
+
+        prefix (如data URL头) 直接写在缓冲区开头, 最终只decode一次即可得到完整字符串
+        """
         try:
             # 记录图片大小
             image_size = len(file_data) / 1024  # KB
-            encoded = base64.b64encode(file_data).decode("utf-8")
-            encoded_size = len(encoded) / 1024  # KB
+            total = len(prefix) + ((len(file_data) + 2) // 3) * 4
+            # 编码结果马上会被拷贝为str, 按实际大小分配即可, 不经过缓冲池
+            encoded = bytearray(total)
+            with memoryview(encoded) as encoded_view:
+                encoded_view[:len(prefix)] = prefix
+                offset = len(prefix)
+                for i in range(0, len(file_data), cls._ENCODE_CHUNK_SIZE):
+                    chunk = binascii.b2a_base64(file_data[i:i + cls._ENCODE_CHUNK_SIZE], newline=False)
+                    encoded_view[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            encoded_str = encoded.decode("ascii")
+            del encoded
+            encoded_size = (total - len(prefix)) / 1024  # KB
             debug_info = f"图片编码完成: 原始大小={image_size:.2f}KB, 编码后大小={encoded_size:.2f}KB"
-            return encoded, debug_info
+            return encoded_str, debug_info
         except Exception as e:
-            stack_trace = traceback.format_exc()
-            raise Exception(f"图片编码失败: {str(e)}\n堆栈跟踪: {stack_trace}")
+            logger.exception("图片编码失败")
+            if cls._DEBUG:
+                raise Exception(f"图片编码失败: {str(e)}\n堆栈跟踪: {traceback.format_exc()}")
+            raise Exception(f"图片编码失败: {str(e)}")
+
+    @classmethod
+    def _download_image(cls, file_url, connect_timeout, read_timeout):
+        """下载图片, 仅在连接失败或读取超时时按指数退避重试, HTTP错误和证书错误不重试"""
+        for attempt in range(cls._DOWNLOAD_RETRIES + 1):
+            try:
+                return cls._fetch_image(file_url, (connect_timeout, read_timeout))
+            except requests.exceptions.SSLError:
+                # SSLError是ConnectionError的子类, 证书问题重试也不会成功
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+                if attempt == cls._DOWNLOAD_RETRIES:
+                    raise
+                time.sleep(cls._DOWNLOAD_BACKOFF * (2 ** attempt))
+
+    @classmethod
+    def _fetch_image(cls, file_url, timeout):
+        """以流式方式下载图片, 直接写入缓冲区, 避免response.content的整份拷贝
+
+        Returns:
+            tuple: (缓冲区, 实际数据长度); 缓冲区用完后应通过_release_buffer归还
+        """
+        with cls._session().get(file_url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            # 有Content-Length时从缓冲池取出缓冲区; 实际长度可能因传输压缩而不同, 超出部分追加写入
+            # Content-Length来自服务端不可信, 预分配大小有上限, 其余随实际收到的数据增长
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > cls._MAX_DOWNLOAD_BYTES:
+                raise Exception(f"图片过大: {content_length/1024/1024:.2f}MB, 超过{cls._MAX_DOWNLOAD_BYTES/1024/1024:.0f}MB上限")
+            buf = cls._acquire_buffer(min(content_length, cls._BUF_POOL_MAX_BYTES))
+            capacity = len(buf)
+            buf_view = memoryview(buf)
+            offset = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                end = offset + len(chunk)
+                if end > cls._MAX_DOWNLOAD_BYTES:
+                    raise Exception(f"图片过大: 超过{cls._MAX_DOWNLOAD_BYTES/1024/1024:.0f}MB上限")
+                if end <= capacity:
+                    buf_view[offset:end] = chunk
+                else:
+                    if buf_view is not None:
+                        buf_view.release()
+                        buf_view = None
+                        del buf[offset:]
+                    buf.extend(chunk)
+                offset = end
+            if buf_view is not None:
+                buf_view.release()
+        return buf, offset
+
+    def _prepare_one(self, image_file, passthrough_url, connect_timeout, read_timeout) -> tuple[Optional[str], list[str]]:
+        """
+        获取单个图片文件的数据并编码为data URL
+
+        Returns:
+            tuple: (图片URL或data URL, 调试消息列表); 处理失败时为None, 错误信息为最后一条消息
+        """
+        messages = []
+        pooled_buf = None
+        try:
+            # 处理不同类型的图片输入
+            file_content = None
+
+            # 检查文件类型并获取文件内容
+            file_url = getattr(image_file, 'url', None)
+            if file_url:
+                # 如果文件是通过URL提供的
+                # 公网可访问的链接由方舟直接获取, 无需下载再编码为base64; 内网链接仍走下载+编码
+                if passthrough_url and _is_public_url(file_url):
+                    messages.append(f"直接使用图片URL: {file_url[:30]}...")
+                    return file_url, messages
+                messages.append(f"正在从URL获取图片: {file_url[:30]}...")
+                try:
+                    pooled_buf, length = self._download_image(file_url, connect_timeout, read_timeout)
+                    file_content = memoryview(pooled_buf)[:length]
+                    messages.append(f"成功下载图片: 大小={len(file_content)/1024:.2f}KB")
+                except Exception as e:
+                    messages.append(f"从URL下载图片失败: {str(e)}")
+                    return None, messages
+
+            # 如果没有URL, 按输入对象的类型获取文件数据
+            if file_content is None:
+                file_content = _load_image(image_file, messages)
+
+            # 如果所有方法都失败
+            if file_content is None:
+                messages.append("无法获取图片数据。请尝试重新上传图片或使用较小的图片文件")
+                return None, messages
+
+            # 编码图片数据为base64 (通过只读memoryview切片, 避免分块时拷贝原始数据)
+            file_view = memoryview(file_content).toreadonly()
+            try:
+                # 构建图片URL (豆包API需要可访问的URL或base64数据)
+                # SDK的image参数只接受字符串, 无法直接传字节; 前缀与编码结果写入同一缓冲区, 避免再拼接一次
+                mime_type = self._sniff_mime(file_view)
+                image_data_url, encoding_debug = self._encode_image(file_view, f"data:{mime_type};base64,".encode("ascii"))
+                messages.append(encoding_debug)
+                return image_data_url, messages
+            except Exception as e:
+                messages.append(f"图片编码失败: {str(e)}")
+                return None, messages
+            finally:
+                file_view.release()
+
+        except Exception as e:
+            logger.exception("处理图片文件失败")
+            if self._DEBUG:
+                messages.append(f"处理图片文件失败: {str(e)}\n堆栈跟踪:\n{traceback.format_exc()}")
+            else:
+                messages.append(f"处理图片文件失败: {str(e)}")
+            return None, messages
+        finally:
+            if pooled_buf is not None:
+                if isinstance(file_content, memoryview):
+                    file_content.release()
+                self._release_buffer(pooled_buf)
+            elif isinstance(file_content, mmap.mmap):
+                file_content.close()
+
+    # 流式事件处理函数: 通过yield输出消息, 返回True表示需要结束生成
+    def _h_partial_failed(self, event, ctx):
+        yield self.create_text_message(f"image_generation.partial_failed. 部分图片生成失败, 错误信息: {event.error}")
+        if event.error is not None and str(getattr(event.error, "code", "")).lower() == "internalserviceerror":
+            yield self.create_text_message(f"InternalServiceError 图片生成失败, 错误信息: {event.error}")
+            return True
+        return False
+
+    def _h_partial_succeeded(self, event, ctx):
+        if event.error is None and event.url:
+            yield from self._emit_image(event, ctx)
+        return False
+
+    def _h_completed(self, event, ctx):
+        if event.error is None:
+            yield self.create_text_message(f"图片生成完成")
+            # 各图片信息已随事件逐条输出, 汇总只包含用量和最近的图片信息
+            output_json = {}
+            output_json['images_info'] = list(ctx["images_info"])
+            output_json['usage'] = event.usage
+            yield self.create_json_message(output_json)
+        # completed是最后一个事件, 无需继续读取流
+        return True
+
+    def _h_partial_image(self, event, ctx):
+        yield from self._emit_image(event, ctx)
+        return False
+
+    def _emit_image(self, event, ctx):
+        """图片一生成就立即输出, 不在内存中累积完整事件"""
+        image_info = {"image_index": event.image_index, "url": event.url}
+        ctx["images_info"].append(image_info)
+        yield self.create_text_message(
+            f"第{event.image_index}张图片生成完成。该链接将在生成后 24 小时内失效，请务必及时保存图像。{(event.url or '')[:64]}")
+        yield self.create_image_message(event.url)
+        yield self.create_json_message(image_info)
+
+    # 事件类型 -> 处理函数, 每个事件只需一次字典查找
+    _EVENT_HANDLERS = {
+        sys.intern("image_generation.partial_failed"): _h_partial_failed,
+        sys.intern("image_generation.partial_succeeded"): _h_partial_succeeded,
+        sys.intern("image_generation.completed"): _h_completed,
+        sys.intern("image_generation.partial_image"): _h_partial_image,
+    }
 
     def _invoke(
         self, tool_parameters: dict
@@ -46,91 +448,49 @@ class Image2ImageTool(Tool):
         api_key = self.runtime.credentials.get("api_key")
         base_url = "https://ark.cn-beijing.volces.com/api/v3"
 
-        # 获取图片文件
-        image_files = tool_parameters.get("image")
-        images_data = []
-        if not image_files:
-            images_data = None
-        else:
-            # 处理图片文件
-            for image_file in image_files:
-                try:
-                    # 处理不同类型的图片输入
-                    file_content = None
-
-                    # 检查文件类型并获取文件内容
-                    if hasattr(image_file, 'url') and image_file.url:
-                        # 如果文件是通过URL提供的
-                        file_url = image_file.url
-                        yield self.create_text_message(f"正在从URL获取图片: {file_url[:30]}...")
-                        try:
-                            response = requests.get(file_url, timeout=60)
-                            response.raise_for_status()
-                            file_content = response.content
-                            yield self.create_text_message(f"成功下载图片: 大小={len(file_content)/1024:.2f}KB")
-                        except Exception as e:
-                            yield self.create_text_message(f"从URL下载图片失败: {str(e)}")
-                            return
-
-                    # 如果URL下载失败或没有URL，尝试其他方法
-                    if file_content is None and hasattr(image_file, 'blob'):
-                        try:
-                            file_content = image_file.blob
-                            yield self.create_text_message(f"从blob属性获取文件数据: 大小={len(image_file.blob)/1024:.2f}KB")
-                        except Exception as e:
-                            yield self.create_text_message(f"获取blob属性失败: {str(e)}")
-
-                    # 尝试从read方法获取
-                    if file_content is None and hasattr(image_file, 'read'):
-                        try:
-                            file_content = image_file.read()
-                            yield self.create_text_message("从可读对象获取文件数据")
-                            # 如果是文件对象，可能需要重置文件指针
-                            if hasattr(image_file, 'seek'):
-                                image_file.seek(0)
-                        except Exception as e:
-                            yield self.create_text_message(f"从read方法获取文件数据失败: {str(e)}")
-
-                    # 尝试作为文件路径处理
-                    if file_content is None and isinstance(image_file, str):
-                        try:
-                            with open(image_file, 'rb') as f:
-                                file_content = f.read()
-                            yield self.create_text_message(f"从文件路径获取文件数据: {image_file}, 大小={len(file_content)/1024:.2f}KB")
-                        except (TypeError, IOError) as e:
-                            yield self.create_text_message(f"从文件路径获取文件数据失败: {str(e)}")
-
-                    # 尝试本地文件缓存方式
-                    if file_content is None and hasattr(image_file, 'path'):
-                        try:
-                            with open(image_file.path, 'rb') as f:
-                                file_content = f.read()
-                            yield self.create_text_message(f"从本地缓存路径获取文件数据: {image_file.path}, 大小={len(file_content)/1024:.2f}KB")
-                        except (TypeError, IOError) as e:
-                            yield self.create_text_message(f"从本地缓存路径获取文件数据失败: {str(e)}")
-
-                    # 如果所有方法都失败
-                    if file_content is None:
-                        yield self.create_text_message("无法获取图片数据。请尝试重新上传图片或使用较小的图片文件")
-                        return
+        # 是否将图片URL直接传给方舟API (关闭时先下载并编码为base64)
+        passthrough_url = tool_parameters.get("passthrough_url_to_ark")
+        passthrough_url = True if passthrough_url is None else bool(passthrough_url)
 
-                    # 编码图片数据为base64
-                    try:
-                        encoded_image, encoding_debug = self._encode_image(file_content)
-                        yield self.create_text_message(encoding_debug)
+        # 下载图片的连接超时和读取超时(秒)
+        connect_timeout = float(tool_parameters.get("connect_timeout") or 5)
+        read_timeout = float(tool_parameters.get("read_timeout") or 60)
 
-                        # 构建图片URL (豆包API需要可访问的URL或base64数据)
-                        image_data_url = f"data:image/jpeg;base64,{encoded_image}"
-                        images_data.append(image_data_url)
-                    except Exception as e:
-                        yield self.create_text_message(f"图片编码失败: {str(e)}")
-                        return
+        # 获取图片文件
+        image_files = tool_parameters.get("image")
+        images_data = [] if image_files else None
+        image_files = image_files or ()
 
+        # 并发获取并编码各图片, 按输入顺序收集结果; 消息统一在主线程中输出
+        # (没有图片时不会提交任务, 线程池也不会创建线程)
+        executor = ThreadPoolExecutor(max_workers=min(self._MAX_PREPARE_WORKERS, len(image_files)) or 1)
+        try:
+            futures = [
+                executor.submit(self._prepare_one, image_file, passthrough_url, connect_timeout, read_timeout)
+                for image_file in image_files
+            ]
+            for future in futures:
+                try:
+                    image_data_url, messages = future.result()
                 except Exception as e:
-                    stack_trace = traceback.format_exc()
-                    yield self.create_text_message(f"处理图片文件失败: {str(e)}\n堆栈跟踪:\n{stack_trace}")
+                    logger.exception("处理图片文件失败")
+                    if self._DEBUG:
+                        yield self.create_text_message(f"处理图片文件失败: {str(e)}\n堆栈跟踪:\n{traceback.format_exc()}")
+                    else:
+                        yield self.create_text_message(f"处理图片文件失败: {str(e)}")
                     return
-        
+                # 每张图片的调试信息合并为一条消息输出, 错误信息单独输出以便区分
+                if image_data_url is None:
+                    if len(messages) > 1:
+                        yield self.create_text_message("\n".join(messages[:-1]))
+                    yield self.create_text_message(messages[-1])
+                    return
+                yield self.create_text_message("\n".join(messages))
+                images_data.append(image_data_url)
+        finally:
+            # 出错提前返回时不等待其余图片, 取消尚未开始的任务
+            executor.shutdown(wait=False, cancel_futures=True)
+
         prompt = tool_parameters.get("prompt")
         model = tool_parameters.get("model")
         image_size = tool_parameters.get("image_size")
@@ -139,7 +499,7 @@ class Image2ImageTool(Tool):
         try:
             yield self.create_text_message("准备生成图片...")
             yield self.create_text_message(f"提示词: {prompt}")
-            client = Ark(base_url=base_url, api_key=api_key)
+            client = self._ark(base_url, api_key)
             images_stream_response = client.images.generate(
                 model=model,
                 prompt=prompt,
@@ -152,34 +512,27 @@ class Image2ImageTool(Tool):
                 watermark=False # 是否在生成的图片中添加水印
             )
 
-            output_json = {}
-            images_info = []
+            ctx = {"images_info": deque(maxlen=self._IMAGES_INFO_RECAP)}
+            handlers = self._EVENT_HANDLERS
             yield self.create_text_message("正在等待图片生成...")
-            for event in images_stream_response:
-                if event is None:
-                    continue
-                if event.type == "image_generation.partial_failed":
-                    yield self.create_text_message(f"image_generation.partial_failed. 部分图片生成失败, 错误信息: {event.error}")
-                    if event.error is not None and event.error.code.equal("InternalServiceError"):
-                        yield self.create_text_message(f"InternalServiceError 图片生成失败, 错误信息: {event.error}")
+            try:
+                for event in images_stream_response:
+                    if event is None:
+                        continue
+                    handler = handlers.get(event.type)
+                    if handler is None:
+                        continue
+                    if (yield from handler(self, event, ctx)):
                         return
-                elif event.type == "image_generation.partial_succeeded":
-                    if event.error is None and event.url:
-                        images_info.append(event)
-                        yield self.create_text_message(f"第{event.image_index}张图片生成完成。该链接将在生成后 24 小时内失效，请务必及时保存图像。{event}")
-                        yield self.create_image_message(event.url)
-                elif event.type == "image_generation.completed":
-                    if event.error is None:
-                        yield self.create_text_message(f"图片生成完成")
-                        output_json['images_info'] = images_info
-                        output_json['usage'] = event.usage
-                        yield self.create_json_message(output_json)
-                elif event.type == "image_generation.partial_image":
-                    images_info.append(event)
-                    yield self.create_text_message(
-                        f"第{event.image_index}张图片生成完成。该链接将在生成后 24 小时内失效，请务必及时保存图像。{event}")
-                    yield self.create_image_message(event.url)
+            finally:
+                # 收到终止事件或出错时立即关闭流, 释放HTTP连接供后续调用复用
+                close = getattr(images_stream_response, "close", None)
+                if close is not None:
+                    close()
         
         except Exception as e:
             # 处理异常
             yield self.create_text_message(f"生成图片时出错: {str(e)}")
+
+
+atexit.register(Image2ImageTool._close_clients)